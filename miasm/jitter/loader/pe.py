@@ -1,10 +1,17 @@
 from builtins import map
+import bisect
 import os
 import struct
 import logging
 from collections import defaultdict
+from itertools import groupby
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 from future.utils import viewitems, viewvalues
+from past.builtins import intern
 
 from miasm.loader import pe
 from miasm.loader import cstruct
@@ -20,6 +27,22 @@ hnd.setFormatter(logging.Formatter("[%(levelname)-8s]: %(message)s"))
 log.addHandler(hnd)
 log.setLevel(logging.INFO)
 
+# raw library name -> lowercase interned str library name
+_LIBNAME_INTERN = {}
+
+
+def _intern_libname(name):
+    """Return the lowercase str version of the library name @name. Results are
+    interned and memoized, so that every import of a given library shares the
+    same key object.
+    @name: library name (bytes or str)
+    """
+    libname = _LIBNAME_INTERN.get(name)
+    if libname is None:
+        libname = intern(force_str(name.lower()))
+        _LIBNAME_INTERN[name] = libname
+    return libname
+
 
 def get_pe_dependencies(pe_obj):
     """Collect the shared libraries upon which this PE depends.
@@ -38,10 +61,7 @@ def get_pe_dependencies(pe_obj):
         return set()
     out = set()
     for dependency in pe_obj.DirImport.impdesc:
-        libname = dependency.dlldescname.name.lower()
-        # transform bytes to str
-        libname = force_str(libname)
-        out.add(libname)
+        out.add(_intern_libname(dependency.dlldescname.name))
 
     # If binary has redirected export, add dependencies
     if pe_obj.DirExport.expdesc != None:
@@ -59,42 +79,101 @@ def get_pe_dependencies(pe_obj):
     return out
 
 
+class ImportAddressMap(Mapping):
+    """Mapping from tuple (dll name string, symbol name string) to list of
+    virtual addresses of the corresponding Import Address Table entries.
+
+    The thunks of a library are only walked the first time one of its symbols
+    is looked up, and the results are memoized in self._cache. Iterating over
+    the mapping (as preload_pe does) parses every import descriptor.
+    """
+
+    def __init__(self, pe_obj):
+        """
+        @pe_obj: pe object
+        """
+        self._pe = pe_obj
+        self._wsize_bytes = pe_obj._wsize // 8
+        self._cache = {}
+        # libname -> import descriptors not parsed yet
+        self._todo = defaultdict(list)
+        if pe_obj.DirImport.impdesc is None:
+            return
+        for s in pe_obj.DirImport.impdesc:
+            libname = _intern_libname(s.dlldescname.name)
+            self._todo[libname].append(s)
+
+    def _parse_descriptor(self, libname, s):
+        """Add IAT entries of the import descriptor @s to the cache"""
+        wsize_bytes = self._wsize_bytes
+        # IAT entries are contiguous: only convert the first thunk address
+        thunk_start = self._pe.rva2virt(s.firstthunk)
+        thunk_ads = range(
+            thunk_start,
+            thunk_start + wsize_bytes * len(s.impbynames),
+            wsize_bytes
+        )
+        cache = self._cache
+        for imp, ad in zip(s.impbynames, thunk_ads):
+            if isinstance(imp, pe.ImportByName):
+                funcname = force_str(imp.name)
+            else:
+                funcname = imp
+            key = (libname, funcname)
+            ads = cache.get(key)
+            if ads is None:
+                cache[key] = [ad]
+            else:
+                ads.append(ad)
+
+    def _parse_lib(self, libname):
+        """Parse every pending import descriptor of @libname"""
+        for s in self._todo.pop(libname, []):
+            self._parse_descriptor(libname, s)
+
+    def _parse_all(self):
+        for libname in list(self._todo):
+            self._parse_lib(libname)
+
+    def __getitem__(self, key):
+        try:
+            libname, _ = key
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        self._parse_lib(libname)
+        return self._cache[key]
+
+    def __iter__(self):
+        self._parse_all()
+        return iter(self._cache)
+
+    def __len__(self):
+        self._parse_all()
+        return len(self._cache)
+
+
 def get_import_address_pe(e):
     """Compute the addresses of imported symbols.
     @e: pe object
-    Returns a dict mapping from tuple (dll name string, symbol name string) to set of virtual addresses.
+    Returns an ImportAddressMap mapping from tuple (dll name string, symbol
+    name string) to list of virtual addresses.
 
     Example:
 
         pe = miasm.analysis.binary.Container.from_string(buf)
         imports = miasm.jitter.loader.pe.get_import_address_pe(pe.executable)
-        assert imports[('api-ms-win-core-rtlsupport-l1-1-0.dll', 'RtlCaptureStackBackTrace')] == {0x6b88a6d0}
+        assert imports[('api-ms-win-core-rtlsupport-l1-1-0.dll', 'RtlCaptureStackBackTrace')] == [0x6b88a6d0]
     """
-    import2addr = defaultdict(set)
-    if e.DirImport.impdesc is None:
-        return import2addr
-    for s in e.DirImport.impdesc:
-        # fthunk = e.rva2virt(s.firstthunk)
-        # l = "%2d %-25s %s" % (i, repr(s.dlldescname), repr(s))
-        libname = force_str(s.dlldescname.name.lower())
-
-        for ii, imp in enumerate(s.impbynames):
-            if isinstance(imp, pe.ImportByName):
-                funcname = force_str(imp.name)
-            else:
-                funcname = imp
-            # l = "    %2d %-16s" % (ii, repr(funcname))
-            import2addr[(libname, funcname)].add(
-                e.rva2virt(s.firstthunk + (e._wsize * ii) // 8)
-            )
-    return import2addr
+    return ImportAddressMap(e)
 
 
 def preload_pe(vm, e, runtime_lib, patch_vm_imp=True):
     fa = get_import_address_pe(e)
     dyn_funcs = {}
+    # IAT entry address -> function address
+    iat = {}
     # log.debug('imported funcs: %s' % fa)
-    for (libname, libfunc), ads in viewitems(fa):
+    for (libname, libfunc), ads in fa.items():
         for ad in ads:
             libname = force_str(libname)
             ad_base_lib = runtime_lib.lib_get_add_base(libname)
@@ -102,9 +181,27 @@ def preload_pe(vm, e, runtime_lib, patch_vm_imp=True):
 
             libname_s = canon_libname_libfunc(libname, libfunc)
             dyn_funcs[libname_s] = ad_libfunc
-            if patch_vm_imp:
-                vm.set_mem(
-                    ad, struct.pack(cstruct.size2type[e._wsize], ad_libfunc))
+            iat[ad] = ad_libfunc
+
+    if patch_vm_imp and iat:
+        # Write each run of contiguous IAT entries with a single set_mem
+        wsize_bytes = e._wsize // 8
+        iat_ads = sorted(iat)
+        # Pack the whole table at once; runs are slices of it
+        packer = struct.Struct(
+            "%d%s" % (len(iat_ads), cstruct.size2type[e._wsize])
+        )
+        packed = packer.pack(*(iat[ad] for ad in iat_ads))
+        run_start = 0
+        for i in range(1, len(iat_ads) + 1):
+            if (i < len(iat_ads) and
+                    iat_ads[i] == iat_ads[i - 1] + wsize_bytes):
+                continue
+            vm.set_mem(
+                iat_ads[run_start],
+                packed[run_start * wsize_bytes:i * wsize_bytes]
+            )
+            run_start = i
     return dyn_funcs
 
 
@@ -120,11 +217,23 @@ def is_redirected_export(pe_obj, addr):
     """
 
     export_dir = pe_obj.NThdr.optentries[pe.DIRECTORY_ENTRY_EXPORT]
+    export_dir_end = export_dir.rva + export_dir.size
     addr_rva = pe_obj.virt2rva(addr)
-    if not (export_dir.rva <= addr_rva < export_dir.rva + export_dir.size):
+    if not (export_dir.rva <= addr_rva < export_dir_end):
+        return False
+    # The forwarder string lies in the export directory: fetch it at once
+    data = pe_obj.rva.get(addr_rva, export_dir_end)
+    data_end = data.find(b'\x00')
+    if data_end >= 0:
+        data = data[:data_end]
+        # Forwarder string: "dllname.funcname" or "dllname.#ordinal"
+        dot = data.find(b'.')
+    if data_end < 0 or not 0 < dot < len(data) - 1:
+        log.warning(
+            "Export 0x%x is in the export directory but is not a valid "
+            "forwarder: %r", addr, data[:0x40]
+        )
         return False
-    addr_end = pe_obj.virt.find(b'\x00', addr)
-    data = pe_obj.virt.get(addr, addr_end)
 
     data = force_str(data)
     dllname, func_info = data.split('.', 1)
@@ -153,18 +262,24 @@ def get_export_name_addr_list(e):
     if e.DirExport.expdesc is None:
         return out
 
+    rva2virt = e.rva2virt
+    f_address = e.DirExport.f_address
+    base = e.DirExport.expdesc.base
+    # Virtual address of each exported function, computed once for both
+    # names and ordinals
+    f_virts = [rva2virt(addr.rva) for addr in f_address]
+
     # add func name
-    for i, n in enumerate(e.DirExport.f_names):
-        addr = e.DirExport.f_address[e.DirExport.f_nameordinals[i].ordinal]
-        f_name = force_str(n.name.name)
-        # log.debug('%s %s' % (f_name, hex(e.rva2virt(addr.rva))))
-        out.append((f_name, e.rva2virt(addr.rva)))
+    out = [
+        (force_str(n.name.name), f_virts[o.ordinal])
+        for n, o in zip(e.DirExport.f_names, e.DirExport.f_nameordinals)
+    ]
 
     # add func ordinal
-    for i, s in enumerate(e.DirExport.f_address):
-        if not s.rva:
-            continue
-        out.append((i + e.DirExport.expdesc.base, e.rva2virt(s.rva)))
+    out += [
+        (i + base, f_virts[i])
+        for i, addr in enumerate(f_address) if addr.rva
+    ]
 
     return out
 
@@ -201,10 +316,7 @@ def vm_load_pe(vm, fdata, align_s=True, load_hdr=True, name="", winobjs=None, **
             min_len = min(pe.SHList[0].addr, 0x1000)
 
             # Get and pad the pe_hdr
-            pe_hdr = (
-                pe.content[:hdr_len] +
-                max(0, (min_len - hdr_len)) * b"\x00"
-            )
+            pe_hdr = bytes(pe.content[:hdr_len]).ljust(min_len, b"\x00")
 
             if winobjs:
                 winobjs.allocated_pages[pe.NThdr.ImageBase] = (pe.NThdr.ImageBase, len(pe_hdr))
@@ -220,11 +332,10 @@ def vm_load_pe(vm, fdata, align_s=True, load_hdr=True, name="", winobjs=None, **
             # Use the next section address to compute the new size
             for i, section in enumerate(pe.SHList[:-1]):
                 new_size = pe.SHList[i + 1].addr - section.addr
+                # section.data is a view of the image limited to
+                # section.size: no need to rewrite it
                 section.size = new_size
                 section.rawsize = new_size
-                section.data = strpatchwork.StrPatchwork(
-                    section.data[:new_size]
-                )
                 section.offset = section.addr
 
             # Last section alignment
@@ -233,8 +344,7 @@ def vm_load_pe(vm, fdata, align_s=True, load_hdr=True, name="", winobjs=None, **
 
         # Pad sections with null bytes and map them
         for section in pe.SHList:
-            data = bytes(section.data)
-            data += b"\x00" * (section.size - len(data))
+            data = bytes(section.data).ljust(section.size, b"\x00")
             attrib = PAGE_READ
             if section.flags & 0x80000000:
                 attrib |= PAGE_WRITE
@@ -255,7 +365,6 @@ def vm_load_pe(vm, fdata, align_s=True, load_hdr=True, name="", winobjs=None, **
     log.warning('PE is not aligned, creating big section')
     min_addr = 0 if load_hdr else None
     max_addr = None
-    data = ""
 
     for i, section in enumerate(pe.SHList):
         if i < len(pe.SHList) - 1:
@@ -276,19 +385,23 @@ def vm_load_pe(vm, fdata, align_s=True, load_hdr=True, name="", winobjs=None, **
     log.debug('Min: 0x%x, Max: 0x%x, Size: 0x%x', min_addr, max_addr,
               (max_addr - min_addr))
 
+    # Copy each sections content in a buffer
+    data = bytearray(max_addr - min_addr)
+    data_view = memoryview(data)
+    for section in pe.SHList:
+        section_addr = pe.rva2virt(section.addr)
+        section_data = bytes(section.data)
+        log.debug('Map 0x%x bytes to 0x%x', len(section_data), section_addr)
+        offset = section_addr - min_addr
+        data_view[offset:offset + len(section_data)] = section_data
+
     # Create only one big section containing the whole PE
     vm.add_memory_page(
         min_addr,
         PAGE_READ | PAGE_WRITE,
-        (max_addr - min_addr) * b"\x00"
+        bytes(data)
     )
 
-    # Copy each sections content in memory
-    for section in pe.SHList:
-        log.debug('Map 0x%x bytes to 0x%x', len(section.data),
-                  pe.rva2virt(section.addr))
-        vm.set_mem(pe.rva2virt(section.addr), bytes(section.data))
-
     return pe
 
 
@@ -354,8 +467,11 @@ def vm2pe(myjit, fname, libs=None, e_orig=None,
 
     mye.NThdr.ImageBase = img_base
     all_mem = myjit.vm.get_all_memory()
-    addrs = list(all_mem)
-    addrs.sort()
+    addrs = sorted(all_mem)
+    # Only keep pages in [min_addr, max_addr[
+    addrs = addrs[
+        bisect.bisect_left(addrs, min_addr):bisect.bisect_left(addrs, max_addr)
+    ]
     entry_point = mye.virt2rva(myjit.pc)
     if entry_point is None or not 0 < entry_point < 0xFFFFFFFF:
         raise ValueError(
@@ -364,22 +480,30 @@ def vm2pe(myjit, fname, libs=None, e_orig=None,
         )
 
     mye.Opthdr.AddressOfEntryPoint = entry_point
-    first = True
+
+    # Merge contiguous pages: (start address, data)
+    runs = []
     for ad in addrs:
-        if not min_addr <= ad < max_addr:
-            continue
         log.debug("0x%x", ad)
+        data = all_mem[ad]['data']
+        if runs and runs[-1][0] + len(runs[-1][1]) == ad:
+            runs[-1][1].extend(data)
+        else:
+            runs.append((ad, bytearray(data)))
+
+    first = True
+    for ad, data in runs:
         if first:
             mye.SHList.add_section(
                 "%.8X" % ad,
                 addr=ad - mye.NThdr.ImageBase,
-                data=all_mem[ad]['data'],
+                data=bytes(data),
                 offset=min_section_offset)
         else:
             mye.SHList.add_section(
                 "%.8X" % ad,
                 addr=ad - mye.NThdr.ImageBase,
-                data=all_mem[ad]['data'])
+                data=bytes(data))
         first = False
     if libs:
         if added_funcs is not None:
@@ -417,7 +541,9 @@ def vm2pe(myjit, fname, libs=None, e_orig=None,
             )
             mye.DirRes.set_rva(s_res.addr)
     # generation
-    open(fname, 'wb').write(bytes(mye))
+    data = bytes(mye)
+    with open(fname, 'wb') as fstream:
+        fstream.write(data)
     return mye
 
 
@@ -474,7 +600,21 @@ class libimp_pe(libimp):
             self.lib_imp2dstad[ad] = {}
             self.libbase_ad += 0x1000
 
+            name_inv = dict(
+                (value, key) for key, value in viewitems(self.name2off)
+            )
+            lia = self.lib_imp2ad[libad]
+
             ads = get_export_name_addr_list(e)
+            # name/ordinal -> address, to resolve self redirections
+            export2addr = dict(ads)
+            if ads:
+                # Only addresses in the export directory may be forwarders.
+                # This mirrors the check done in is_redirected_export, to
+                # skip the call for the common, non forwarded, exports
+                export_dir = e.NThdr.optentries[pe.DIRECTORY_ENTRY_EXPORT]
+                export_dir_start = e.rva2virt(export_dir.rva)
+                export_dir_end = export_dir_start + export_dir.size
             todo = list(ads)
             # done = []
             while todo:
@@ -483,20 +623,16 @@ class libimp_pe(libimp):
 
                 # if export is a redirection, search redirected dll
                 # and get function real addr
-                ret = is_redirected_export(e, ad)
+                if export_dir_start <= ad < export_dir_end:
+                    ret = is_redirected_export(e, ad)
+                else:
+                    ret = False
                 if ret:
                     exp_dname, exp_fname = ret
-                    exp_dname = exp_dname + '.dll'
-                    exp_dname = exp_dname.lower()
+                    exp_dname = _intern_libname(exp_dname + '.dll')
                     # if dll auto refes in redirection
                     if exp_dname == name:
-                        libad_tmp = self.name2off[exp_dname]
-                        if isinstance(exp_fname, str):
-                            exp_fname = bytes(ord(c) for c in exp_fname)
-                        found = None
-                        for tmp_func, tmp_addr in ads:
-                            if tmp_func == exp_fname:
-                                found = tmp_addr
+                        found = export2addr.get(exp_fname)
                         assert found is not None
                         ad = found
                     else:
@@ -513,10 +649,7 @@ class libimp_pe(libimp):
                         libad_tmp = self.name2off[exp_dname]
                         ad = self.lib_imp2ad[libad_tmp][exp_fname]
 
-                self.lib_imp2ad[libad][imp_ord_or_name] = ad
-                name_inv = dict(
-                    (value, key) for key, value in viewitems(self.name2off)
-                )
+                lia[imp_ord_or_name] = ad
                 c_name = canon_libname_libfunc(
                     name_inv[libad], imp_ord_or_name)
                 self.fad2cname[ad] = c_name
@@ -555,17 +688,18 @@ class libimp_pe(libimp):
             all_ads = all_ads[i:]
             log.debug('ads: %s', list(map(hex, all_ads)))
 
-            while all_ads:
-                # Find libname's Import Address Table
-                othunk = all_ads[0]
-                i = 0
-                while (i + 1 < len(all_ads) and
-                       all_ads[i] + target_pe._wsize // 8 == all_ads[i + 1]):
-                    i += 1
-                # 'i + 1' is IAT's length
+            # Find libname's Import Address Tables: in a run of contiguous
+            # entries, address - index * stride is constant
+            stride = target_pe._wsize // 8
+            for _, iat in groupby(
+                    enumerate(all_ads),
+                    lambda index_addr: index_addr[1] - index_addr[0] * stride
+            ):
+                iat = [addr for _, addr in iat]
+                othunk = iat[0]
 
                 # Effectively build an IMAGE_IMPORT_DESCRIPTOR
-                funcs = [out_ads[addr] for addr in all_ads[:i + 1]]
+                funcs = [out_ads[addr] for addr in iat]
                 try:
                     rva = target_pe.virt2rva(othunk)
                 except pe.InvalidOffset:
@@ -576,9 +710,6 @@ class libimp_pe(libimp):
                                     funcs)
                                    )
 
-                # Update elements to handle
-                all_ads = all_ads[i + 1:]
-
         return new_lib
 
 
@@ -0,0 +1,232 @@
+import logging
+import os
+import struct
+import tempfile
+
+from miasm.loader.pe_init import PE
+from miasm.jitter.loader.pe import get_import_address_pe, \
+    get_export_name_addr_list, is_redirected_export, libimp_pe, preload_pe, \
+    vm_load_pe, vm2pe
+
+
+class MockVm(object):
+    """Minimal VmMngr: store pages and record set_mem calls"""
+
+    def __init__(self):
+        self.pages = {}
+        self.writes = []
+
+    def add_memory_page(self, addr, access, data, name=""):
+        self.pages[addr] = {"data": data, "size": len(data), "access": access}
+
+    def set_mem(self, addr, data):
+        self.writes.append((addr, data))
+        for base, page in self.pages.items():
+            if base <= addr and addr + len(data) <= base + page["size"]:
+                offset = addr - base
+                page["data"] = (page["data"][:offset] + data +
+                                page["data"][offset + len(data):])
+                return
+        raise RuntimeError("Unmapped address 0x%x" % addr)
+
+    def get_all_memory(self):
+        return self.pages
+
+
+class MockJitter(object):
+
+    def __init__(self, vm, pc):
+        self.vm = vm
+        self.pc = pc
+
+
+# Library exporting code symbols and forwarders
+LIB_BASE = 0x10000000
+FORWARDERS = [
+    (b"FwdExt", b"OTHER.FuncX"),
+    (b"FwdOrd", b"other.#7"),
+    (b"FwdSelf", b"mylib.FuncB"),
+    (b"FwdMangled", b"msvcrt.??2@YAPAXI@Z"),
+]
+
+
+def build_lib(forwarders=FORWARDERS):
+    pe_obj = PE()
+    pe_obj.NThdr.ImageBase = LIB_BASE
+    pe_obj.SHList.add_section(
+        name="text", addr=0x1000, rawsize=0x1000, data=b"\xc3" * 0x100
+    )
+    pe_obj.DirExport.create(name=b"mylib.dll")
+    for i, name in enumerate([b"FuncA", b"FuncB", b"FuncC"]):
+        pe_obj.DirExport.add_name(name, rva=0x1000 + 0x10 * i)
+    for name, _ in forwarders:
+        pe_obj.DirExport.add_name(name, rva=0)
+    s_exp = pe_obj.SHList.add_section(name="edata", rawsize=0x1000)
+
+    # Forwarder strings are stored at the end of the export directory
+    dir_size = len(pe_obj.DirExport)
+    strings = b""
+    name2rva = {}
+    for name, target in forwarders:
+        name2rva[name] = s_exp.addr + dir_size + len(strings)
+        strings += target + b"\x00"
+    pe_obj.DirExport.set_rva(s_exp.addr, dir_size + len(strings))
+    for i, func in enumerate(pe_obj.DirExport.f_names):
+        if func.name.name in name2rva:
+            ordinal = pe_obj.DirExport.f_nameordinals[i].ordinal
+            pe_obj.DirExport.f_address[ordinal].rva = name2rva[func.name.name]
+
+    raw = bytearray(bytes(pe_obj))
+    offset = pe_obj.rva2off(s_exp.addr + dir_size)
+    raw[offset:offset + len(strings)] = strings
+    return PE(bytes(raw))
+
+
+# Binary importing from the library, with two IATs for mylib.dll
+EXE_BASE = 0x400000
+
+
+def build_exe():
+    pe_obj = PE()
+    pe_obj.NThdr.ImageBase = EXE_BASE
+    s_text = pe_obj.SHList.add_section(
+        name="text", addr=0x1000, rawsize=0x1000, data=b"\xc3"
+    )
+    pe_obj.Opthdr.AddressOfEntryPoint = s_text.addr
+    pe_obj.DirImport.add_dlldesc([
+        ({"name": "MYLIB.dll", "firstthunk": s_text.addr + 0x100},
+         ["FuncA", "FuncB", "FwdExt"]),
+        ({"name": "kernel32.dll", "firstthunk": s_text.addr + 0x200},
+         ["CreateFileA", "WriteFile"]),
+        ({"name": "mylib.dll", "firstthunk": s_text.addr + 0x300},
+         ["FuncA"]),
+    ])
+    s_imp = pe_obj.SHList.add_section(name="myimp", rawsize=0x1000)
+    pe_obj.DirImport.set_rva(s_imp.addr)
+    return bytes(pe_obj)
+
+
+# get_import_address_pe
+imports = get_import_address_pe(PE(build_exe()))
+assert imports[("mylib.dll", "FuncA")] == [0x401100, 0x401300]
+assert imports.get(("mylib.dll", "FuncB")) == [0x401104]
+assert imports.get(("mylib.dll", "Unknown")) is None
+assert ("kernel32.dll", "WriteFile") in imports
+assert ("kernel32.dll", "ReadFile") not in imports
+assert dict(imports) == {
+    ("mylib.dll", "FuncA"): [0x401100, 0x401300],
+    ("mylib.dll", "FuncB"): [0x401104],
+    ("mylib.dll", "FwdExt"): [0x401108],
+    ("kernel32.dll", "CreateFileA"): [0x401200],
+    ("kernel32.dll", "WriteFile"): [0x401204],
+}
+
+# get_export_name_addr_list / is_redirected_export
+lib = build_lib()
+exports = get_export_name_addr_list(lib)
+export2addr = dict(exports)
+assert export2addr["FuncA"] == export2addr[1] == LIB_BASE + 0x1000
+assert export2addr["FuncB"] == export2addr[2] == LIB_BASE + 0x1010
+assert export2addr["FuncC"] == export2addr[3] == LIB_BASE + 0x1020
+assert len(exports) == 2 * (3 + len(FORWARDERS))
+
+assert is_redirected_export(lib, export2addr["FuncA"]) is False
+assert is_redirected_export(lib, export2addr["FwdExt"]) == ("other", "FuncX")
+assert is_redirected_export(lib, export2addr["FwdOrd"]) == ("other", 7)
+assert is_redirected_export(lib, export2addr["FwdSelf"]) == ("mylib", "FuncB")
+assert is_redirected_export(lib, export2addr["FwdMangled"]) == (
+    "msvcrt", "??2@YAPAXI@Z"
+)
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+# Malformed forwarder strings are reported, not considered as redirections
+bad_lib = build_lib([(b"FwdNoDot", b"nodot"), (b"FwdNoFunc", b"other.")])
+bad_export2addr = dict(get_export_name_addr_list(bad_lib))
+handler = RecordHandler()
+logging.getLogger("loader_pe").addHandler(handler)
+try:
+    assert is_redirected_export(bad_lib, bad_export2addr["FwdNoDot"]) is False
+    assert is_redirected_export(bad_lib, bad_export2addr["FwdNoFunc"]) is False
+finally:
+    logging.getLogger("loader_pe").removeHandler(handler)
+assert [record.levelno for record in handler.records] == [logging.WARNING] * 2
+
+# add_export_lib
+libs = libimp_pe()
+libs.add_export_lib(lib, "mylib.dll")
+lib_ad = libs.name2off["mylib.dll"]
+assert lib_ad == LIB_BASE
+assert libs.cname2addr["mylib_FuncA"] == LIB_BASE + 0x1000
+assert libs.cname2addr[("mylib", 1)] == LIB_BASE + 0x1000
+# Self redirection is resolved to the target export
+assert libs.cname2addr["mylib_FwdSelf"] == LIB_BASE + 0x1010
+assert libs.lib_imp2ad[lib_ad]["FwdSelf"] == LIB_BASE + 0x1010
+# Redirection to a non loaded library creates a dummy entry
+other_ad = libs.name2off["other.dll"]
+assert "other.dll" in libs.fake_libs
+assert libs.created_redirected_imports["other.dll"] == set(["mylib.dll"])
+assert libs.cname2addr["mylib_FwdExt"] == libs.lib_imp2ad[other_ad]["FuncX"]
+assert libs.cname2addr["mylib_FwdOrd"] == libs.lib_imp2ad[other_ad][7]
+msvcrt_ad = libs.name2off["msvcrt.dll"]
+assert libs.cname2addr["mylib_FwdMangled"] == \
+    libs.lib_imp2ad[msvcrt_ad]["??2@YAPAXI@Z"]
+
+# preload_pe
+vm = MockVm()
+exe = vm_load_pe(vm, build_exe())
+dyn_funcs = preload_pe(vm, exe, libs)
+k32_ad = libs.name2off["kernel32.dll"]
+assert dyn_funcs["mylib_FuncA"] == LIB_BASE + 0x1000
+assert dyn_funcs["kernel32_WriteFile"] == libs.lib_imp2ad[k32_ad]["WriteFile"]
+# One write per contiguous IAT
+assert [addr for addr, _ in vm.writes] == [0x401100, 0x401200, 0x401300]
+text = vm.pages[0x401000]["data"]
+assert struct.unpack("<3I", text[0x100:0x10c]) == (
+    LIB_BASE + 0x1000,
+    LIB_BASE + 0x1010,
+    libs.lib_imp2ad[other_ad]["FuncX"],
+)
+assert struct.unpack("<2I", text[0x200:0x208]) == (
+    libs.lib_imp2ad[k32_ad]["CreateFileA"],
+    libs.lib_imp2ad[k32_ad]["WriteFile"],
+)
+assert struct.unpack("<I", text[0x300:0x304]) == (LIB_BASE + 0x1000,)
+
+# vm2pe: contiguous pages (text and myimp) are merged in a single section
+fdesc, fname = tempfile.mkstemp()
+os.close(fdesc)
+try:
+    vm2pe(MockJitter(vm, 0x401000), fname, libs=libs, e_orig=exe)
+    with open(fname, "rb") as fstream:
+        dump = PE(fstream.read())
+finally:
+    os.remove(fname)
+sections = [(section.name, section.addr) for section in dump.SHList]
+assert sections[0] == (b"00401000", 0x1000)
+assert dump.SHList[0].size == 0x2000
+assert dump.virt.get(0x402000, 0x403000) == vm.pages[0x402000]["data"]
+assert get_import_address_pe(dump)[("kernel32.dll", "WriteFile")] == [0x401204]
+
+# gen_new_lib reflects updates made directly to lib_imp2dstad
+libs = libimp_pe()
+lib_ad = libs.lib_get_add_base("kernel32.dll")
+libs.lib_get_add_func(lib_ad, "CreateFileA", 0x401000)
+exe = PE(build_exe())
+assert libs.gen_new_lib(exe) == [
+    ({"name": "kernel32.dll", "firstthunk": 0x1000}, ["CreateFileA"]),
+]
+libs.lib_imp2dstad[lib_ad]["CreateFileA"].add(0x401004)
+assert libs.gen_new_lib(exe) == [
+    ({"name": "kernel32.dll", "firstthunk": 0x1000},
+     ["CreateFileA", "CreateFileA"]),
+]
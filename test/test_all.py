@@ -476,6 +476,7 @@ for script in ["jitload.py",
     for engine in ArchUnitTest.jitter_engines:
         testset += RegressionTest([script, engine], base_dir="jitter",
                                   tags=[TAGS.get(engine,None)])
+testset += RegressionTest(["loader_pe.py"], base_dir="jitter")
 
 
 # Examples